@@ -1,19 +1,28 @@
 #!/usr/bin/env python3
 # generate_rss.py
 import requests
-from bs4 import BeautifulSoup
-from dateutil import parser as dateparser
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from html import escape as _html_escape
+import lxml.etree
+import lxml.html
 from email.utils import format_datetime
 from datetime import datetime, timezone
+from functools import lru_cache
 import hashlib
+import json
 import os, sys
+import re
 import time
 
-TARGET = "https://cdscoonline.gov.in/CDSCO/cdscoDrugs"
+BASE_URL = "https://cdscoonline.gov.in"
+TARGET = BASE_URL + "/CDSCO/cdscoDrugs"
 OUTPUT = "cdsco-drugs-rss.xml"
 CHANNEL_TITLE = "CDSCO - cdscoDrugs (auto)"
 CHANNEL_LINK = TARGET
 CHANNEL_DESC = "Automated RSS for CDSCO cdscoDrugs page (generated)."
+# ETag / Last-Modified of the last page we built OUTPUT from
+CACHE_FILE = os.path.join(os.path.dirname(OUTPUT), ".rss-cache.json")
 
 HEADERS = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
@@ -29,128 +38,241 @@ HEADERS = {
     "Cache-Control": "max-age=0"
 }
 
-def fetch_page(url, max_retries=5):
-    """Fetch page with retry logic and exponential backoff"""
-    for attempt in range(max_retries):
-        try:
-            print(f"Attempt {attempt + 1}/{max_retries} to fetch {url}")
-            r = requests.get(url, headers=HEADERS, timeout=120, verify=True)
+# date-like substrings, e.g. 12/03/2024, 2024-03-12, 12 Mar 2024
+_DATE_RE = re.compile(
+    r"\b(\d{1,4}[-/.]\d{1,2}[-/.]\d{2,4}"
+    r"|\d{1,2}\s+(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]*\s+\d{2,4})\b",
+    re.I,
+)
+
+# links worth keeping regardless of title length: PDFs, uploads, downloads
+_LINK_RE = re.compile(r"\.pdf|/uploads/|uploads|download|viewfile", re.I)
+
+
+def _make_session():
+    """Shared session: keep-alive connection pooling plus retry/backoff"""
+    retry = Retry(total=5, backoff_factor=2, status_forcelist=[502, 503, 504])
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=retry)
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+_SESSION = _make_session()
+
+# the adapter's Retry only covers connecting and waiting for headers; a body
+# that dies mid-read is retried here
+BODY_READ_RETRIES = 3
+
+def load_cache():
+    try:
+        with open(CACHE_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(cache):
+    with open(CACHE_FILE, "w", encoding="utf-8") as f:
+        json.dump(cache, f, indent=2)
+
+def fetch_page(url, cache=None):
+    """Conditional GET over the shared session.
+
+    Connection and 5xx retries are handled by the adapter; failures while
+    reading the body are retried here.
+
+    The body is streamed and hashed as it arrives, so the snapshot hash comes
+    for free. Returns (html_bytes, encoding, raw_hash, validators); encoding
+    is the Content-Type charset or None, and everything but validators is
+    None when the server answers 304.
+    """
+    headers = {}
+    # only ask for a 304 if we still have the feed it would point us back to
+    if cache and os.path.exists(OUTPUT):
+        if cache.get("etag"):
+            headers["If-None-Match"] = cache["etag"]
+        if cache.get("last_modified"):
+            headers["If-Modified-Since"] = cache["last_modified"]
+    
+    for attempt in range(1, BODY_READ_RETRIES + 1):
+        print(f"Fetching {url}")
+        with _SESSION.get(url, headers=headers, timeout=120, verify=True, stream=True) as r:
             r.raise_for_status()
-            print(f"Successfully fetched page (status: {r.status_code})")
-            return r.text
-        except requests.exceptions.ConnectionError as e:
-            print(f"Connection error on attempt {attempt + 1}: {e}")
-            if attempt < max_retries - 1:
-                wait_time = (2 ** attempt) * 5  # Exponential backoff: 5, 10, 20, 40, 80 seconds
-                print(f"Waiting {wait_time} seconds before retry...")
-                time.sleep(wait_time)
-            else:
-                print(f"Failed to connect after {max_retries} attempts")
-                raise
-        except requests.exceptions.Timeout as e:
-            print(f"Timeout error on attempt {attempt + 1}: {e}")
-            if attempt < max_retries - 1:
-                wait_time = (2 ** attempt) * 3
-                print(f"Waiting {wait_time} seconds before retry...")
-                time.sleep(wait_time)
-            else:
-                raise
-        except requests.exceptions.RequestException as e:
-            print(f"Request error on attempt {attempt + 1}: {e}")
-            if attempt < max_retries - 1:
-                wait_time = (2 ** attempt) * 3
+            validators = {"etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+            if r.status_code == 304:
+                print("Page not modified since last run (status: 304)")
+                return None, None, None, validators
+            
+            # content-change check only, not security sensitive
+            h = hashlib.blake2b(digest_size=20)
+            buf = []
+            try:
+                for chunk in r.iter_content(65536):
+                    h.update(chunk)
+                    buf.append(chunk)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError) as e:
+                print(f"Body read failed on attempt {attempt}/{BODY_READ_RETRIES}: {e}")
+                if attempt == BODY_READ_RETRIES:
+                    raise
+                wait_time = (2 ** (attempt - 1)) * 5  # 5, 10 seconds
                 print(f"Waiting {wait_time} seconds before retry...")
                 time.sleep(wait_time)
-            else:
-                raise
+                continue
+            print(f"Successfully fetched page (status: {r.status_code})")
+            # only trust r.encoding when the server actually sent a charset;
+            # otherwise requests falls back to ISO-8859-1 for text/html
+            has_charset = "charset" in r.headers.get("Content-Type", "").lower()
+            encoding = r.encoding if has_charset else None
+            return b"".join(buf), encoding, h.hexdigest(), validators
+
+@lru_cache(maxsize=None)
+def _html_parser(encoding=None):
+    """One lxml parser per encoding; None lets libxml2 sniff <meta charset>"""
+    try:
+        return lxml.html.HTMLParser(encoding=encoding)
+    except LookupError:
+        # unknown charset in the Content-Type header
+        return lxml.html.HTMLParser()
+
+@lru_cache(maxsize=None)
+def _parse_date(text):
+    """Parse a _DATE_RE match into a tz-aware datetime, or None.
+
+    Listing pages repeat the same few dates, so each distinct string only
+    goes through dateutil once. dateutil is imported here rather than at
+    module level so runs without any date-like text never pay for it.
+    """
+    from dateutil import parser as dateparser
+    
+    try:
+        dt = dateparser.parse(text)
+    except (ValueError, OverflowError):
+        return None
+    # store tz-aware so iter_rss can format it as-is
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+def _node_text(node):
+    # comments/processing instructions have no text worth reading
+    return " ".join(node.itertext()) if isinstance(node.tag, str) else ""
 
-def find_links(html):
-    soup = BeautifulSoup(html, "lxml")
-    main = soup.find(id="content") or soup
-    anchors = main.find_all("a", href=True)
+def _text_before(a, limit=120):
+    """Up to ~limit chars of text preceding anchor `a` inside its parent"""
+    parts = []
+    size = 0
+    node = a.getprevious()
+    # walk back over siblings (tail first, then the sibling's own text)
+    while node is not None and size < limit:
+        for text in (node.tail, _node_text(node)):
+            if text:
+                parts.append(text)
+                size += len(text)
+        node = node.getprevious()
+    parent = a.getparent()
+    if size < limit and parent is not None and parent.text:
+        parts.append(parent.text)
+    return " ".join(reversed(parts))[-limit:]
+
+def _text_after(a, limit=120):
+    """Up to ~limit chars of text following anchor `a` inside its parent"""
+    parts = [a.tail or ""]
+    size = len(parts[0])
+    node = a.getnext()
+    while node is not None and size < limit:
+        for text in (_node_text(node), node.tail):
+            if text:
+                parts.append(text)
+                size += len(text)
+        node = node.getnext()
+    return " ".join(parts)[:limit]
+
+def find_links(html, encoding=None):
+    try:
+        tree = lxml.html.fromstring(html, parser=_html_parser(encoding))
+    except lxml.etree.ParserError:
+        # empty/whitespace-only body: no items, iter_rss emits the snapshot entry
+        return []
+    main = tree.xpath('//*[@id="content"]')
+    anchors = (main[0] if main else tree).xpath(".//a[@href]")
     
     items = []
     seen = set()
     
     for a in anchors:
-        href = a["href"].strip()
+        href = a.get("href").strip()
         if href.startswith("javascript:") or href.startswith("#"):
             continue
         
         # normalize link
         if href.startswith("/"):
-            link = "https://cdscoonline.gov.in" + href
+            link = BASE_URL + href
         elif href.lower().startswith("http"):
             link = href
         else:
             link = TARGET.rstrip("/") + "/" + href.lstrip("/")
         
-        title = a.get_text(" ", strip=True) or link
+        # join text nodes with a space so <br>/inline tags keep word breaks
+        title = " ".join(" ".join(a.itertext()).split()) or link
         
         # basic filter: PDFs, downloads, or descriptive links
-        if any(x in link.lower() for x in [".pdf", "/uploads/", "download", "viewfile", "uploads"]) or len(title) > 6:
+        if _LINK_RE.search(link) or len(title) > 6:
             if link in seen:
                 continue
             seen.add(link)
             
             item = {"title": title, "link": link, "guid": link, "description": ""}
             
-            # try to find a nearby date text (parent/next sibling)
-            parent_text = a.parent.get_text(" ", strip=True) if a.parent else ""
+            # try to find a nearby date text: only the text directly around
+            # the anchor, not the whole parent subtree
+            near_text = f"{_text_before(a)} {title} {_text_after(a)}"
             
-            # attempt to parse any date-like substring
-            for token in parent_text.split():
-                try:
-                    dt = dateparser.parse(token, fuzzy=False)
+            # only hand the first date-like substring to the parser
+            m = _DATE_RE.search(near_text)
+            if m:
+                dt = _parse_date(m.group(1))
+                if dt:
                     item["pubDate"] = dt
-                    break
-                except Exception:
-                    continue
             
             items.append(item)
     
     return items
 
-def build_rss(items, raw_snapshot_hash):
+def iter_rss(items, raw_snapshot_hash):
+    """Yield the feed piece by piece (header, one chunk per item, footer)"""
     now = datetime.now(timezone.utc)
+    now_str = format_datetime(now)
     
-    header = f'''<?xml version="1.0" encoding="utf-8"?>
+    yield f'''<?xml version="1.0" encoding="utf-8"?>
 <rss version="2.0">
   <channel>
     <title>{CHANNEL_TITLE}</title>
     <link>{CHANNEL_LINK}</link>
     <description>{CHANNEL_DESC}</description>
-    <lastBuildDate>{format_datetime(now)}</lastBuildDate>
+    <lastBuildDate>{now_str}</lastBuildDate>
     <language>en-IN</language>
 '''
     
-    body = ""
-    
     # if we found no link-like items, include a snapshot entry so readers see when page changed
     if not items:
         snapshot_title = f"Snapshot update — page changed ({now.strftime('%Y-%m-%d %H:%M:%S %Z')})"
-        body += f"""    <item>
+        yield f"""    <item>
       <title>{escape_xml(snapshot_title)}</title>
       <link>{CHANNEL_LINK}</link>
       <description>Page snapshot changed; content hash: {raw_snapshot_hash}</description>
-      <pubDate>{format_datetime(now)}</pubDate>
+      <pubDate>{now_str}</pubDate>
       <guid isPermaLink="false">{raw_snapshot_hash}</guid>
     </item>\n"""
     else:
         for it in items:
             pub = it.get("pubDate")
-            if not pub:
-                pub = now
-            elif not pub.tzinfo:
-                pub = pub.replace(tzinfo=timezone.utc)
-            
-            pubstr = format_datetime(pub)
+            pubstr = format_datetime(pub) if pub else now_str
             title = escape_xml(it["title"])
             link = it["link"]
             guid = it["guid"]
             desc = escape_xml(it.get("description",""))
             
-            body += f"""    <item>
+            yield f"""    <item>
       <title>{title}</title>
       <link>{link}</link>
       <description>{desc}</description>
@@ -158,34 +280,30 @@ def build_rss(items, raw_snapshot_hash):
       <guid isPermaLink="true">{guid}</guid>
     </item>\n"""
     
-    footer = "  </channel>\n</rss>\n"
-    return header + body + footer
+    yield "  </channel>\n</rss>\n"
 
 def escape_xml(s):
-    s = str(s)
-    return (s.replace("&", "&amp;")
-             .replace("<", "&lt;")
-             .replace(">", "&gt;")
-             .replace('"', "&quot;")
-             .replace("'", "&apos;"))
+    # html.escape covers & < > " via str.replace; keep the XML &apos; spelling
+    return _html_escape(str(s), quote=True).replace("&#x27;", "&apos;")
 
 def main():
     try:
         print(f"Starting RSS generation for {TARGET}")
-        html = fetch_page(TARGET)
+        cache = load_cache()
+        html, encoding, raw_hash, validators = fetch_page(TARGET, cache)
+        if html is None:
+            print(f"✓ {OUTPUT} is up to date, nothing to do")
+            return
         
-        # compute snapshot hash
-        raw_hash = hashlib.sha1(html.encode("utf-8")).hexdigest()
         print(f"Page hash: {raw_hash}")
         
-        items = find_links(html)
+        items = find_links(html, encoding)
         print(f"Found {len(items)} items")
         
-        rss = build_rss(items, raw_hash)
-        
-        # Write output
-        with open(OUTPUT, "w", encoding="utf-8") as f:
-            f.write(rss)
+        # Write output as it is generated
+        with open(OUTPUT, "w", encoding="utf-8", buffering=1 << 16) as f:
+            f.writelines(iter_rss(items, raw_hash))
+        save_cache(validators)
         
         print(f"✓ Successfully wrote {OUTPUT} with {len(items)} items")
         print(f"✓ Snapshot hash: {raw_hash}")
@@ -217,6 +335,9 @@ def main():
         
         with open(OUTPUT, "w", encoding="utf-8") as f:
             f.write(fallback_rss)
+        # the fallback feed must not be served again on a later 304
+        if os.path.exists(CACHE_FILE):
+            os.remove(CACHE_FILE)
         
         print(f"✓ Wrote fallback RSS feed to {OUTPUT}")
         # Don't exit with error code - we still created a valid RSS file